@@ -1,5 +1,109 @@
 from dtype import *
 
+def _pivot_partners(counts:list[int],
+                    fermionic:tuple[bool, ...],
+                    compat_mask:tuple[int, ...]):
+    """
+    Find the classes that the pivot, the first operator of the first class left in counts, is contracted with.
+    Args:
+        counts (list[int]): How many operators of each class are left, decoded from the state.
+        See _contract for the others.
+    Yields:
+        (j, multiplicity) (tuple[int, int]): A partner class and the multiplicity of contracting the pivot with it,
+            which counts every operator of that class and includes the fermionic sign.
+    """
+    p = next(c for c, count in enumerate(counts) if count)
+    pivot_is_fermionic = fermionic[p]
+    total = 0 # live fermionic operators from the pivot up to the last operator of class j
+    for j in range(p, len(counts)):
+        if fermionic[j]: # bosonic operators commute with everything, so they never change the sign
+            total += counts[j]
+        identical = counts[j] - 1 if j == p else counts[j] # the pivot itself is not a partner
+        if identical <= 0 or not compat_mask[p] >> j & 1:
+            continue
+        # the sign is that of the last operator of the class, total - 2 fermionic operators away from the pivot
+        if pivot_is_fermionic and (total - 2) & 1:
+            yield j, -identical
+        else:
+            yield j, identical
+
+def _branches(state:int,
+              fermionic:tuple[bool, ...],
+              compat_mask:tuple[int, ...],
+              radix:tuple[int, ...]) -> list[tuple[int, int, int]]:
+    """
+    Contract the pivot in every possible way.
+    Args:
+        See _contract.
+    Returns:
+        branches (list[tuple[int, int, int]]): The contracted pair of classes (p, j) packed as the int p * len(radix) + j, its multiplicity
+            and the state left afterwards, for each partner of the pivot. Empty if some live operator has no live partner left.
+    """
+    counts = [] # decode the state into the count of each class
+    weights = []
+    weight = 1
+    digits = state
+    for r in radix:
+        digits, count = divmod(digits, r)
+        counts.append(count)
+        weights.append(weight)
+        weight *= r
+    live = 0
+    for c, count in enumerate(counts):
+        if count:
+            live |= 1 << c
+    for c, count in enumerate(counts): # give up at once if some live operator has no live partner left
+        if count and not compat_mask[c] & (live if count > 1 else live & ~(1 << c)):
+            return []
+    p = (live & -live).bit_length() - 1 # the pivot is the first operator of the first class left
+    branches = []
+    for j, multiplicity in _pivot_partners(counts, fermionic, compat_mask):
+        branches.append((p * len(radix) + j, multiplicity, state - weights[p] - weights[j])) # remove the two contracted operators
+    return branches
+
+def _contract(state:int,
+              fermionic:tuple[bool, ...],
+              compat_mask:tuple[int, ...],
+              radix:tuple[int, ...],
+              cache:dict) -> list[tuple[tuple, int]]:
+    """
+    Enumerate the Wick contractions of the operators left in state.
+    Args:
+        state (int): How many operators of each class are still waiting to be contracted, as a mixed-radix number
+            whose c-th digit, in base radix[c], is the count of class c. A class is a distinct operator; classes are numbered in sorted order.
+        fermionic (tuple[bool, ...]): Whether each class is fermionic.
+        compat_mask (tuple[int, ...]): Bit j of compat_mask[i] is set if classes i and j can be contracted together.
+        radix (tuple[int, ...]): One more than the number of operators of each class in the input.
+        cache (dict): Contractions already found, keyed by state. Must contain the entry {0: [((), 1)]}.
+    Returns:
+        contractions (list[tuple[tuple, int]]): Each contraction with its multiplicity. A contraction is a linked list
+            (pair, rest) of the packed pairs of classes contracted together (see _branches), ending with (), so that contractions sharing
+            their remaining pairs share the same tail.
+    """
+    # walk the sub-problems with an explicit stack instead of recursion:
+    # a state is solved once all the states its branches lead to are in the cache.
+    # Everything pushed above an expanded state has fewer operators left, so when the walk
+    # gets back to an expanded state, all of its branches have been solved.
+    expanded = {}
+    stack = [state]
+    while stack:
+        current = stack[-1]
+        if current in cache:
+            stack.pop()
+            continue
+        if current not in expanded:
+            expanded[current] = _branches(current, fermionic, compat_mask, radix)
+            depth = len(stack)
+            stack.extend(rest for _, _, rest in expanded[current] if rest not in cache)
+            if len(stack) > depth:
+                continue
+        stack.pop()
+        cache[current] = [((pair, pairs), multiplicity * multiplicity_in_this_layer)
+                          for pair, multiplicity_in_this_layer, rest in expanded.pop(current)
+                          for pairs, multiplicity in cache[rest]]
+    # the multiplicity is 1 for now, we haven't implemented symmetry for internal vertices yet
+    return cache[state]
+
 def contraction(operators:list[Operator],LSZ_reduction:bool = False) -> list[tuple[Diagram,int]]:
     """
     Perform Wick contraction on a list of quantum field operators.
@@ -7,106 +111,153 @@ def contraction(operators:list[Operator],LSZ_reduction:bool = False) -> list[tup
         operators (list[Operator]): A list of quantum field operators to be contracted.
         LSZ_reduction (bool): If True, treat external operators as external fields. Apply LSZ reduction by forbidding external operators contract. Default is False.
     Returns:
-        diagrams (list[tuple[Diagram,int]]): A list of tuples, each containing a Diagram object representing a unique contraction and an integer representing its multiplicity.
+        diagrams (list[tuple[Diagram,int]]): A list of tuples, each containing a unique Diagram object and an integer representing its multiplicity, summed over the contractions that give this diagram. Diagrams whose multiplicities cancel to zero are left out.
     Raises:
         ValueError: If the number of operators is not even or if the number of creation and annihilation operators are not equal.
         ValueError: If the input is not a list of Operator objects.
+        ValueError: If no contraction with a nonzero multiplicity exists.
     Example:
     >>> from contraction import Operator, contraction
     >>> operators = [Operator('a','f',0), Operator('b','f',0), Operator('c','f',0), Operator('d','f',0)]
     >>> diagrams = contraction(operators)
     >>> for diagram, multiplicity in diagrams:
-            print(f"Diagram: {diagram}, Multiplicity: {multiplicity}")
-        Diagram: Outer vertices: {'a', 'b', 'c', 'd'}
-            Inner vertices: set()
-            Propagators: [f(a---b), f(c---d)], Multiplicity: 1
-        Diagram: Outer vertices: {'a', 'b', 'c', 'd'}
-            Inner vertices: set()
-            Propagators: [f(a---c), f(b---d)], Multiplicity: 1
-        Diagram:Outer vertices: {'a', 'b', 'c', 'd'}
-            Inner vertices: set()
-            Propagators: [f(a---d), f(b---c)], Multiplicity: 1
-        ####################
-    >>> for diagram,multiplicity in contraction([Field('a','f',0,fermionic=True),
-            Field('b','f',0,fermionic=True),
-            Field('c','f',0,fermionic=True),
-            Field('d','f',0,fermionic=True)]):
-            print(f"Multiplicity: {multiplicity}", diagram)
-        Multiplicity: 1      Outer vertices: set()
-            Inner vertices: {'d', 'a', 'b', 'c'}
-            Propagators: [f(a---b), f(c---d)]
-        Multiplicity: -1      Outer vertices: set()
-            Inner vertices: {'d', 'a', 'b', 'c'}
-            Propagators: [f(a---c), f(b---d)]
-        Multiplicity: 1      Outer vertices: set()
-            Inner vertices: {'d', 'a', 'b', 'c'}
-            Propagators: [f(a---d), f(b---c)]
+    ...     print(f"Diagram: {diagram.pretty()}, Multiplicity: {multiplicity}")
+    Diagram: Outer vertices: ()
+            Inner vertices: ('a', 'b', 'c', 'd')
+            Propagators: f: a---b, f: c---d, Multiplicity: 1
+    Diagram: Outer vertices: ()
+            Inner vertices: ('a', 'b', 'c', 'd')
+            Propagators: f: a---c, f: b---d, Multiplicity: 1
+    Diagram: Outer vertices: ()
+            Inner vertices: ('a', 'b', 'c', 'd')
+            Propagators: f: a---d, f: b---c, Multiplicity: 1
+    >>> for diagram, multiplicity in contraction([Operator('a','f',0,fermionic=True),
+    ...                                           Operator('b','f',0,fermionic=True),
+    ...                                           Operator('c','f',0,fermionic=True),
+    ...                                           Operator('d','f',0,fermionic=True)]):
+    ...     print(f"Multiplicity: {multiplicity}", diagram.pretty())
+    Multiplicity: 1 Outer vertices: ()
+            Inner vertices: ('a', 'b', 'c', 'd')
+            Propagators: f: a---b, f: c---d
+    Multiplicity: -1 Outer vertices: ()
+            Inner vertices: ('a', 'b', 'c', 'd')
+            Propagators: f: a---c, f: b---d
+    Multiplicity: 1 Outer vertices: ()
+            Inner vertices: ('a', 'b', 'c', 'd')
+            Propagators: f: a---d, f: b---c
     """
+    if not isinstance(operators, list):
+        raise ValueError('The operators must be given as a list of Operator objects')
     if len(operators) % 2 != 0:
         raise ValueError("The number of operators must be even for contraction.")
-    if not isinstance(operators, list) and not all(isinstance(op, Operator) for op in operators):
-        raise ValueError('The type of the operator must be type field in the list')
-    if not sum(op.charge for op in operators) == 0:
-        raise ValueError("The number of creation and annihilation operators must be equal.")
-
-    operators.sort()
-
-    inner_vertices = tuple(set(op.pos for op in operators if not op.external))
-    outer_vertices = tuple(set(op.pos for op in operators if op.external))
 
-    all_possible_contraction = []
+    # group identical operators into classes and only keep how many operators each class has,
+    # so that the search never tells identical operators apart. This is the only pass over the
+    # input, and it also checks the type of each operator.
+    class_counts = {}
+    for op in operators:
+        if not isinstance(op, Operator):
+            raise ValueError('The operators must be given as a list of Operator objects')
+        class_counts[op] = class_counts.get(op, 0) + 1
+    distinct_ops = sorted(class_counts) # classes are numbered in sorted order
+    counts = tuple(class_counts[op] for op in distinct_ops)
+    inner, outer = set(), set()
+    for op in distinct_ops:
+        (outer if op.external else inner).add(op.pos)
+    # pack the counts into one int, so that states are cheap to hash and to update
+    radix = tuple(count + 1 for count in counts)
+    state = 0
+    for count, r in zip(reversed(counts), reversed(radix)):
+        state = state * r + count
+    # sorted, so that the vertices of a diagram do not depend on set iteration order
+    inner_vertices = tuple(sorted(inner))
+    outer_vertices = tuple(sorted(outer))
+    # lower the classes to parallel columns of ints, so that the search below never dispatches
+    # through the Operator dataclass methods
+    charge = tuple(op.charge for op in distinct_ops)
+    if sum(c * n for c, n in zip(charge, counts)) != 0:
+        raise ValueError("The number of creation and annihilation operators must be equal.")
+    # every contraction removes one creation and one annihilation operator, or two neutral operators, of the
+    # same type and statistics, so if these do not balance from the start no branch of the search can complete
+    balance = {}
+    for op, count in zip(distinct_ops, counts):
+        key = (op.type, op.fermionic, op.charge == 0)
+        balance[key] = balance.get(key, 0) + (op.charge * count if op.charge else count)
+    if any(b % 2 if neutral else b for (_, _, neutral), b in balance.items()):
+        raise ValueError("No valid contraction found. Please check the input operators.")
+    fermionic = tuple(op.fermionic for op in distinct_ops)
+    # whether two classes can be contracted does not depend on their positions, so decide it once
+    # for each kind (type, charge, fermionic, external) of operator and spread it to the classes
+    kinds = {}
+    kind_members = [] # bit c of kind_members[k] is set if class c is of kind k
+    for c, op in enumerate(distinct_ops):
+        k = kinds.setdefault((op.type, op.charge, op.fermionic, op.external), len(kinds))
+        if k == len(kind_members):
+            kind_members.append(0)
+        kind_members[k] |= 1 << c
+    kind_compat_mask = [ # bit c of kind_compat_mask[k] is set if class c can be contracted with an operator of kind k
+        sum(kind_members[l] for (other_type, other_charge, other_fermionic, other_external), l in kinds.items()
+            if other_type == type_ and other_fermionic == fermionic_ and other_charge + charge_ == 0
+            and not (LSZ_reduction and other_external and external_)) # if LSZ reduction is applied, we will not contract external operators
+        for type_, charge_, fermionic_, external_ in kinds]
+    # bit j of compat_mask[i] is set if classes i and j can be contracted together
+    compat_mask = tuple(kind_compat_mask[kinds[op.type, op.charge, op.fermionic, op.external]] for op in distinct_ops)
+    if not operators:
+        contractions = []
+    else:
+        cache = {0: [((), 1)]} # contractions of the remaining operators, keyed by their state
+        contractions = _contract(state, fermionic, compat_mask, radix, cache)
 
-    def contract(to_be_contract:list[Operator],
-                 contracted:list[Propagator] = [],
-                 multiplicity:int = 1)->list[tuple[list[Propagator],int]]:
-        if len(to_be_contract) == 2: # if there is only one pair left, contract them
-            pair = to_be_contract[0] + to_be_contract[1]
-            all_possible_contraction.append((contracted + [pair],multiplicity))
-            return # return to the previous level of recursion
-        multiplicity_in_this_layer = 1 # initialize the multiplicity for this layer of recursion
-        for i in range(1,len(to_be_contract)): # contract the first operator with the ith operator
-            if (i < len(to_be_contract) - 1) and (to_be_contract[i] == to_be_contract[i+1]): # if the two operators are the same, we skip the next one to avoid double counting
-                multiplicity_in_this_layer += 1
-                continue
-            elif LSZ_reduction and to_be_contract[0].external and to_be_contract[i].external: # if LSZ reduction is applied, we will not contract external operators
-                continue
-            try:
-                pair = to_be_contract[0] + to_be_contract[i]
-            except TypeError:
-                continue
-            if to_be_contract[0].fermionic and (i % 2 == 0): # if the operator is fermionic, we need to consider the sign
-                multiplicity_in_this_layer *= -1
-            contract(
-                to_be_contract[1:i] + to_be_contract[i+1:],  # remove the two contracted operators
-                contracted + [pair],                         # add the contracted pair to the list
-                multiplicity * multiplicity_in_this_layer    # update the multiplicity
-            )
-            multiplicity_in_this_layer = 1  # reset the multiplicity for the next iteration
+    # the same multiset of class pairs is reached through different orders of contraction, so merge
+    # the terms on their sorted packed pairs first, which is much cheaper than building a Diagram for each
+    terms = {}
+    for pairs , multiplicity in contractions:
+        term = []
+        while pairs: # flatten the linked list of pairs
+            pair, pairs = pairs
+            term.append(pair)
+        term.sort()
+        term = tuple(term)
+        terms[term] = terms.get(term, 0) + multiplicity
 
-        return all_possible_contraction     # the multiplicity is 1 for now, 
-                                            # we haven't implemented symmetry for internal vertices yet
+    # only now unpack the class pairs and turn them into Propagator objects
+    propagators = {}
+    # distinct class pairs give distinct propagators, unless two classes share their position, type and charge
+    # (e.g. an internal and an external operator at the same position); only then can different terms give equal diagrams
+    merge = len({(op.pos, op.type, op.charge) for op in distinct_ops}) < len(distinct_ops)
+    indices = {} # index of each diagram in return_list, only used to merge equal diagrams
     return_list = []
-    for propagators , multiplicity in contract(operators):
-        if len(propagators) != len(operators) // 2:
+    for term , multiplicity in terms.items():
+        if not multiplicity: # fermionic signs can cancel, and a term that adds up to zero does not contribute
             continue
-        return_list.append(
-            (Diagram(outer_vertices,inner_vertices,tuple(propagators)),
-             multiplicity))
+        for pair in term:
+            if pair not in propagators:
+                p, j = divmod(pair, len(radix))
+                propagators[pair] = distinct_ops[p] + distinct_ops[j]
+        diagram = Diagram(outer_vertices,inner_vertices,tuple(propagators[pair] for pair in term))
+        if merge:
+            i = indices.setdefault(diagram, len(return_list))
+            if i < len(return_list): # contractions giving the same diagram are merged by adding up their multiplicities
+                return_list[i] = (return_list[i][0], return_list[i][1] + multiplicity)
+                continue
+        return_list.append((diagram, multiplicity))
+    if merge:
+        return_list = [(diagram, multiplicity) for diagram, multiplicity in return_list if multiplicity]
     if return_list == []:
         raise ValueError("No valid contraction found. Please check the input operators.")
     return return_list
 
 if __name__ == "__main__":
-    operators = [Fermion('1','e',1,external=True),
-                Fermion('2','e',1,external=True),
-                Fermion('3','e',-1,external=True),
-                Fermion('4','e',-1,external=True),
-                Uncharged_Boson('x','a'),
-                Uncharged_Boson('y','a'),
-                Fermion('x','e',1),
-                Fermion('y','e',1),
-                Fermion('x','e',-1),
-                Fermion('y','e',-1)]
+    operators = [fermion('1','e',1,external=True),
+                fermion('2','e',1,external=True),
+                fermion('3','e',-1,external=True),
+                fermion('4','e',-1,external=True),
+                uncharged_boson('x','a'),
+                uncharged_boson('y','a'),
+                fermion('x','e',1),
+                fermion('y','e',1),
+                fermion('x','e',-1),
+                fermion('y','e',-1)]
     # ee -> ee scattering with internal photon exchange
     for diagram,multiplicity in contraction(operators,LSZ_reduction=True):
-        print(f"Multiplicity: {multiplicity}", diagram)
\ No newline at end of file
+        print(f"Multiplicity: {multiplicity}", diagram.pretty())
\ No newline at end of file
@@ -1,6 +1,9 @@
 from dataclasses import dataclass,field
+from functools import cached_property
 from typing import Tuple
 
+# only these are exported by `from dtype import *`, so that helpers such as dataclasses.field do not leak into importers
+__all__ = ['Operator', 'Propagator', 'Diagram', 'uncharged_boson', 'charged_boson', 'fermion']
 
 @dataclass(order=True, frozen=True, slots=True)
 class Operator:
@@ -20,7 +23,7 @@ class Operator:
     external: bool = False
 
     def __post_init__(self):
-        if self.charge not in {1, -1, 0}:
+        if self.charge != 1 and self.charge != -1 and self.charge != 0:
             raise ValueError("charge must be 1, -1, or 0")
     
     def __add__(self, other: 'Operator') -> 'Propagator':
@@ -47,20 +50,21 @@ class Propagator:
         initial (str): The initial vertex of the propagator.
         final (str): The final vertex of the propagator.
         arrow (bool): True if the propagator has an arrow (fermionic), False otherwise (bosonic).
+            Without an arrow the endpoints are stored in sorted order, so equal propagators have equal fields.
     '''
     type: str
     initial: str
     final: str
     arrow: bool
     def __repr__(self) -> str:
-        return f"{self.type}: {self.initial}{'->-' if self.arrow else '---'}{self.final}"
-    def __eq__(self, other: 'Propagator') -> bool:
-        if self.type != other.type or self.arrow != other.arrow:
-            return False
-        elif self.arrow:
-            return (self.initial,self.final) == (other.initial,other.final) # arrow direction matters
-        else:
-            return ((self.initial,self.final) == (other.initial,other.final)) or ((self.initial,self.final) == (other.final,other.initial)) # direction does not matter
+        return self.pretty()
+    def pretty(self) -> str:
+        return "".join((self.type, ": ", self.initial, "->-" if self.arrow else "---", self.final))
+    def __post_init__(self):
+        if not self.arrow and self.final < self.initial: # direction does not matter, store the endpoints in sorted order
+            initial, final = self.final, self.initial
+            object.__setattr__(self, 'initial', initial)
+            object.__setattr__(self, 'final', final)
 
 @dataclass(frozen=True)
 class Diagram:
@@ -70,80 +74,147 @@ class Diagram:
         outer_vertices (Tuple[str, ...]): A tuple of outer vertex labels.
         inner_vertices (Tuple[str, ...]): A tuple of inner vertex labels.
         propagators (Tuple[Propagator, ...]): A tuple of Propagator objects representing the connections between vertices.
+            The constructor keeps them in the given order; use sorted_propagators for the canonical order.
     Properties:
-        list_of_particles (List[Tuple[str, bool]]): A list of unique particle types and their statistics (charged or uncharged) present in the diagram.
+        sorted_propagators (Tuple[Propagator, ...]): The propagators in sorted order, computed on first access. Equality and hashing use it.
+        list_of_particles (Tuple[Tuple[str, bool], ...]): A sorted tuple of unique particle types and their statistics (charged or uncharged) present in the diagram, computed on first access.
+        canonical (tuple): A form of the diagram that does not depend on the labels of the inner vertices, computed on first access.
+            Outer vertices keep their labels, since they are physically distinguishable.
     Methods:
-        is_equivalent(other: 'Diagram') -> bool: Check if two diagrams are equivalent (isomorphic).
+        pretty() -> str: A readable multi-line description of the diagram. The repr only gives the number of propagators.
+        is_equivalent(other: 'Diagram') -> bool: Check if two diagrams are equivalent (isomorphic), by comparing their canonical forms.
     '''
     outer_vertices: Tuple[str, ...] = field(compare=True)
     inner_vertices: Tuple[str, ...] = field(compare=True)  
     propagators: Tuple[Propagator, ...] = field(compare=True)
     
-    def __post_init__(self):
-        object.__setattr__(self, 'propagators', tuple(sorted(self.propagators)))
-    
-    @property
-    def list_of_particles(self) -> set[Tuple[str, bool]]:
-        return set((p.type, p.arrow) for p in self.propagators)
+    @cached_property
+    def sorted_propagators(self) -> Tuple[Propagator, ...]:
+        return tuple(sorted(self.propagators))
+
+    def __eq__(self, other: 'Diagram') -> bool:
+        if not isinstance(other, Diagram):
+            return NotImplemented
+        return (self.outer_vertices == other.outer_vertices and
+                self.inner_vertices == other.inner_vertices and
+                self.sorted_propagators == other.sorted_propagators)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    @cached_property
+    def _hash(self) -> int: # computed once, since it has to hash every propagator
+        return hash((self.outer_vertices, self.inner_vertices, self.sorted_propagators))
+
+    @cached_property
+    def list_of_particles(self) -> Tuple[Tuple[str, bool], ...]:
+        return tuple(sorted({(p.type, p.arrow) for p in self.propagators}))
     
     def __repr__(self) -> str:
-        return f"""Outer vertices: {self.outer_vertices}
-        Inner vertices: {self.inner_vertices}
-        Propagators: {self.propagators}"""
+        return f"<Diagram n={len(self.propagators)}>"
+    def pretty(self) -> str:
+        return "Outer vertices: {}\n        Inner vertices: {}\n        Propagators: {}".format(
+            self.outer_vertices, self.inner_vertices, ", ".join([p.pretty() for p in self.sorted_propagators]))
+    @cached_property
+    def canonical(self) -> tuple:
+        # Inner vertices are only linked to each other through inner vertices, since the outer vertices keep their
+        # labels, so they split into connected components that are canonicalized on their own and then sorted.
+        # Otherwise identical components (e.g. vacuum bubbles) would be tried in every order.
+        # Outer vertices are ranked by label, the inner vertices of a component get the following ranks in the order
+        # that gives the lexicographically smallest edge list. An edge is keyed by its highest rank first, so the
+        # edges closed by ranking a vertex come after all the edges already closed, and a partial edge list is a prefix.
+        outer = sorted(set(self.outer_vertices))
+        ranks = {v: (0, v) for v in outer}
+        incident = {v: [] for v in self.inner_vertices if v not in ranks}
+        for p in self.propagators:
+            for v in {p.initial, p.final}:
+                if v not in ranks:
+                    incident.setdefault(v, []).append(p)
+
+        def edge(p: Propagator) -> tuple:
+            a, b = ranks[p.initial], ranks[p.final]
+            return (max(a, b), min(a, b), p.type, p.arrow, a <= b or not p.arrow)
+
+        best = None
+        def search(prefix: tuple, left: list) -> None:
+            nonlocal best
+            if not left:
+                if best is None or prefix < best:
+                    best = prefix
+                return
+            r = len(ranks) - len(outer)
+            blocks = {}
+            for v in left:
+                ranks[v] = (1, r)
+                blocks[v] = tuple(sorted(edge(p) for p in incident[v] if p.initial in ranks and p.final in ranks))
+                del ranks[v]
+            # only the vertices with the smallest block can start the smallest edge list; a block that is a prefix
+            # of another one is larger, since the next edge of the longer one has a lower highest rank
+            smallest = min(block + (((1, r + 1),),) for block in blocks.values())
+            for v in left:
+                if blocks[v] + (((1, r + 1),),) != smallest:
+                    continue
+                candidate = prefix + blocks[v]
+                if best is not None and candidate > best[:len(candidate)]:
+                    continue
+                ranks[v] = (1, r)
+                search(candidate, [u for u in left if u != v])
+                del ranks[v]
+
+        components = []
+        seen = set()
+        for v in sorted(incident):
+            if v in seen:
+                continue
+            seen.add(v)
+            component = [v]
+            for u in component: # the list grows while it is walked, so it ends up holding the whole component
+                for p in incident[u]:
+                    for w in (p.initial, p.final):
+                        if w in incident and w not in seen:
+                            seen.add(w)
+                            component.append(w)
+            best = None
+            search((), component)
+            components.append((len(component), best))
+        fixed = tuple(sorted(edge(p) for p in self.propagators if p.initial in ranks and p.final in ranks))
+        return (tuple(outer), len(incident), fixed, tuple(sorted(components)))
+
     def is_equivalent(self, other: 'Diagram') -> bool:
-        pass
+        return self.canonical == other.canonical
 
-@dataclass(frozen=True)
-class Uncharged_Boson(Operator):
+def uncharged_boson(pos: str, type: str, external: bool = False) -> Operator:
     '''
-    A class representing an uncharged scalar particle. Inherits from Operator.
-    Attributes:
+    Create an uncharged bosonic operator (e.g. a scalar or a photon).
+    Args:
         pos (str): The position or label of the particle (e.g., 'x', 'y', 'p1', 'k2').
         type (str): The type of the particle (e.g., 'phi' for scalar field).
         external (bool): True if the particle is external, False if internal.
     '''
-    pos: str
-    type: str
-    charge: int = 0
-    external: bool = False
-    def __post_init__(self):
-        object.__setattr__(self, 'fermionic', False)
+    return Operator(pos, type, 0, False, external)
 
-@dataclass(frozen=True)
-class Charged_Boson(Operator):
+def charged_boson(pos: str, type: str, charge: int, external: bool = False) -> Operator:
     '''
-    A class representing a charged bosonic particle. Inherits from Operator.
-    Attributes:
+    Create a charged bosonic operator.
+    Args:
         pos (str): The position or label of the particle (e.g., 'x', 'y', 'p1', 'k2').
         type (str): The type of the particle (e.g., 'W+' for W boson).
         charge (int): The charge of the particle (1 for creation, -1 for annihilation).
         external (bool): True if the particle is external, False if internal.
     '''
-    pos: str
-    type: str
-    charge: int
-    external: bool = False
-    def __post_init__(self):
-        if self.charge not in {1, -1}:
-            raise ValueError("charge must be 1 or -1 for Charged_Boson")
-        object.__setattr__(self, 'fermionic', False)
+    if charge != 1 and charge != -1:
+        raise ValueError("charge must be 1 or -1 for a charged boson")
+    return Operator(pos, type, charge, False, external)
 
-
-@dataclass(frozen=True)
-class Fermion(Operator):
+def fermion(pos: str, type: str, charge: int, external: bool = False) -> Operator:
     '''
-    A class representing a fermionic particle. Inherits from Operator.
-    Attributes:
+    Create a fermionic operator.
+    Args:
         pos (str): The position or label of the particle (e.g., 'x', 'y', 'p1', 'k2').
         type (str): The type of the particle (e.g., 'e' for electron).
         charge (int): The charge of the particle (1 for creation, -1 for annihilation).
         external (bool): True if the particle is external, False if internal.
     '''
-    pos: str
-    type: str
-    charge: int
-    external: bool = False
-    def __post_init__(self):
-        if self.charge not in {1, -1}:
-            raise ValueError("charge must be 1 or -1 for Fermion")
-        object.__setattr__(self, 'fermionic', True)
\ No newline at end of file
+    if charge != 1 and charge != -1:
+        raise ValueError("charge must be 1 or -1 for a fermion")
+    return Operator(pos, type, charge, True, external)
@@ -0,0 +1,105 @@
+import unittest
+
+from contraction import contraction
+from dtype import *
+
+
+def brute_force_pairings(operators: list, LSZ_reduction: bool):
+    '''
+    Yield every complete pairing of the operators, one operator at a time, with its fermionic sign.
+    '''
+    if not operators:
+        yield (), 1
+        return
+    first, rest = operators[0], operators[1:]
+    for k, other in enumerate(rest):
+        if not first.__can_contract_with__(other) or (LSZ_reduction and first.external and other.external):
+            continue
+        # moving the partner next to the first operator passes every fermionic operator in between
+        sign = -1 if first.fermionic and sum(op.fermionic for op in rest[:k]) % 2 else 1
+        for propagators, rest_sign in brute_force_pairings(rest[:k] + rest[k + 1:], LSZ_reduction):
+            yield (first + other,) + propagators, sign * rest_sign
+
+
+def brute_force_contraction(operators: list, LSZ_reduction: bool = False) -> dict:
+    '''
+    Contract the operators in sorted order, like contraction() does, and merge equal diagrams.
+    '''
+    operators = sorted(operators)
+    outer_vertices = tuple(sorted({op.pos for op in operators if op.external}))
+    inner_vertices = tuple(sorted({op.pos for op in operators if not op.external}))
+    diagrams = {}
+    for propagators, sign in brute_force_pairings(operators, LSZ_reduction):
+        diagram = Diagram(outer_vertices, inner_vertices, propagators)
+        diagrams[diagram] = diagrams.get(diagram, 0) + sign
+    return {diagram: multiplicity for diagram, multiplicity in diagrams.items() if multiplicity}
+
+
+class TestContraction(unittest.TestCase):
+    def check_against_brute_force(self, operators: list, LSZ_reduction: bool = False) -> None:
+        result = contraction(list(operators), LSZ_reduction=LSZ_reduction)
+        self.assertEqual(len(result), len({diagram for diagram, _ in result}))
+        self.assertEqual(dict(result), brute_force_contraction(operators, LSZ_reduction))
+
+    def test_fermionic_signs(self):
+        self.check_against_brute_force([Operator(v, 'f', 0, fermionic=True) for v in 'abcd'])
+        self.check_against_brute_force([Operator(v, 'f', 0, fermionic=True) for v in 'abcdef'])
+        self.check_against_brute_force([fermion(v, 'e', q) for v in 'xyz' for q in (1, -1)])
+
+    def test_lsz_reduction(self):
+        operators = [fermion('1', 'e', 1, True), fermion('2', 'e', 1, True),
+                     fermion('3', 'e', -1, True), fermion('4', 'e', -1, True)]
+        operators += [op for v in 'xy' for op in (fermion(v, 'e', 1), fermion(v, 'e', -1), uncharged_boson(v, 'a'))]
+        self.check_against_brute_force(operators, LSZ_reduction=True)
+        self.check_against_brute_force(operators)
+        operators = [uncharged_boson('1', 'phi', True), uncharged_boson('2', 'phi', True)]
+        operators += [uncharged_boson('x', 'phi')] * 4
+        self.check_against_brute_force(operators, LSZ_reduction=True)
+        self.check_against_brute_force(operators)
+
+    def test_identical_operators(self):
+        self.check_against_brute_force([uncharged_boson('x', 'phi')] * 8)
+        self.check_against_brute_force([uncharged_boson(v, 'phi') for v in 'xyz' for _ in range(4)])
+        self.check_against_brute_force([uncharged_boson('x', 'phi')] * 3 + [uncharged_boson('y', 'phi')] * 3)
+
+    def test_mixed_types(self):
+        operators = [op for v in 'xyz' for op in (fermion(v, 'e', 1), fermion(v, 'e', -1), uncharged_boson(v, 'a'))]
+        operators += [charged_boson('x', 'W', 1), charged_boson('w', 'W', -1), uncharged_boson('w', 'a')]
+        operators += [uncharged_boson('y', 'phi'), uncharged_boson('z', 'phi')]
+        self.check_against_brute_force(operators)
+
+    def test_internal_and_external_at_the_same_position(self):
+        operators = [uncharged_boson('x', 'phi', True), uncharged_boson('x', 'phi'),
+                     uncharged_boson('y', 'phi'), uncharged_boson('z', 'phi')]
+        self.check_against_brute_force(operators)
+
+    def test_cancelling_multiplicities(self):
+        operators = [fermion('x', 'e', 1, True), fermion('x', 'e', 1), fermion('y', 'e', -1), fermion('z', 'e', -1)]
+        with self.assertRaises(ValueError):
+            contraction(operators)
+        with self.assertRaises(ValueError): # identical fermionic operators anticommute, so their product vanishes
+            contraction([fermion('x', 'e', 1)] * 2 + [fermion('y', 'e', -1), fermion('z', 'e', -1)])
+
+    def test_empty_input(self):
+        with self.assertRaises(ValueError):
+            contraction([])
+
+    def test_invalid_input(self):
+        with self.assertRaises(ValueError):
+            contraction(tuple(uncharged_boson(v, 'phi') for v in 'xy'))
+        with self.assertRaises(ValueError):
+            contraction([uncharged_boson('x', 'phi'), 'phi(y)'])
+        with self.assertRaises(ValueError):
+            contraction([uncharged_boson(v, 'phi') for v in 'xyz'])
+        with self.assertRaises(ValueError):
+            contraction([charged_boson('x', 'W', 1), charged_boson('y', 'W', 1)])
+
+    def test_unbalanced_types(self):
+        with self.assertRaises(ValueError):
+            contraction([uncharged_boson('x', 'a'), uncharged_boson('y', 'phi')])
+        with self.assertRaises(ValueError):
+            contraction([charged_boson('x', 'W', 1), fermion('y', 'e', -1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import itertools
+import random
+import unittest
+
+from contraction import contraction
+from dtype import *
+
+
+def brute_force_equivalent(first: Diagram, second: Diagram) -> bool:
+    '''
+    Check if two diagrams are isomorphic by trying every relabeling of the inner vertices.
+    '''
+    if sorted(set(first.outer_vertices)) != sorted(set(second.outer_vertices)):
+        return False
+    outer = set(first.outer_vertices)
+    first_inner = sorted(set(first.inner_vertices) - outer)
+    second_inner = sorted(set(second.inner_vertices) - outer)
+    if len(first_inner) != len(second_inner):
+        return False
+    target = sorted(second.propagators)
+    for labels in itertools.permutations(second_inner):
+        relabel = dict(zip(first_inner, labels))
+        relabeled = sorted(Propagator(p.type, relabel.get(p.initial, p.initial), relabel.get(p.final, p.final), p.arrow)
+                           for p in first.propagators)
+        if relabeled == target:
+            return True
+    return False
+
+
+def relabeled(diagram: Diagram, labels: dict) -> Diagram:
+    return Diagram(diagram.outer_vertices,
+                   tuple(labels.get(v, v) for v in diagram.inner_vertices),
+                   tuple(Propagator(p.type, labels.get(p.initial, p.initial), labels.get(p.final, p.final), p.arrow)
+                         for p in diagram.propagators))
+
+
+class TestCanonical(unittest.TestCase):
+    def check_against_brute_force(self, diagrams: list) -> None:
+        for first, second in itertools.combinations(diagrams, 2):
+            self.assertEqual(first.is_equivalent(second), brute_force_equivalent(first, second),
+                             (first.pretty(), second.pretty()))
+
+    def test_qed_diagrams(self):
+        operators = [fermion('x', 'e', 1, True), fermion('y', 'e', -1, True)]
+        for v in 'zw':
+            operators += [fermion(v, 'e', 1), fermion(v, 'e', -1), uncharged_boson(v, 'a')]
+        diagrams = [diagram for diagram, _ in contraction(operators, LSZ_reduction=True)]
+        rng = random.Random(0)
+        for diagram in list(diagrams):
+            diagrams.append(relabeled(diagram, dict(zip('zw', rng.sample('zw', 2)))))
+        self.check_against_brute_force(diagrams)
+
+    def test_phi4_diagrams(self):
+        operators = [uncharged_boson(v, 'phi') for v in 'wxyz' for _ in range(4)]
+        diagrams = [diagram for diagram, _ in contraction(operators)]
+        rng = random.Random(1)
+        sample = rng.sample(diagrams, 30)
+        for diagram in list(sample):
+            sample.append(relabeled(diagram, dict(zip('wxyz', rng.sample('wxyz', 4)))))
+        self.check_against_brute_force(sample)
+
+    def test_many_identical_components(self):
+        # seven disconnected two-vertex bubbles, which took seconds when all inner vertices were ranked together
+        vertices = 'abcdefghijklmn'
+        bubbles = Diagram((), tuple(vertices), tuple(Propagator('phi', vertices[i], vertices[i + 1], False)
+                                                      for i in range(0, len(vertices), 2) for _ in range(2)))
+        other = relabeled(bubbles, dict(zip(vertices, reversed(vertices))))
+        self.assertTrue(bubbles.is_equivalent(other))
+        # each bubble is canonicalized on its own, so the form has one identical entry per bubble
+        components = bubbles.canonical[-1]
+        self.assertEqual(len(components), 7)
+        self.assertEqual(len(set(components)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()